@@ -0,0 +1,93 @@
+import sys
+import os
+import json
+import hashlib
+import subprocess
+from importlib import metadata
+
+def _split_requirement(requirement):
+    name, _, version = requirement.partition("==")
+    return name, version or None
+
+def _release(version):
+    parts = version.split(".")
+    while len(parts) > 1 and parts[-1] == "0":
+        parts.pop()
+    return parts
+
+def _installed_version(name):
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+def _is_satisfied(requirement, versions):
+    name, version = _split_requirement(requirement)
+    installed = versions.get(name)
+    if installed is None:
+        return False
+    return version is None or _release(installed) == _release(version)
+
+def _site_directories():
+    """
+    Modification times of the directories packages are installed into, which change
+    whenever a package is installed, upgraded or removed.
+    """
+    directories = {}
+    for path in sys.path:
+        if ("site-packages" in path or "dist-packages" in path) and os.path.isdir(path):
+            directories[path] = os.stat(path).st_mtime
+    return directories
+
+def _stamp_path(required):
+    key = json.dumps([sys.executable, sys.version, sorted(required)])
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache, "rgbwatermark", f"environment-{digest}.json")
+
+def _read_stamp(path):
+    try:
+        file = open(path, "r")
+        stamp = json.load(file)
+        file.close()
+        return stamp
+    except (OSError, ValueError):
+        return None
+
+def _write_stamp(path, stamp):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file = open(path, "w")
+        json.dump(stamp, file, indent=4)
+        file.close()
+    except OSError:
+        pass
+
+def ensure_requirements(required, no_install=None):
+    """
+    Makes sure the required packages ("name" or "name==version") are installed.
+
+    A stamp keyed on the interpreter and the requirements records the verified package
+    versions, and the full check only runs again once the site-packages directories change.
+    Missing packages are installed with pip unless --no-install is on the command line or
+    RGBWATERMARK_NO_INSTALL is set, in which case the script exits with the missing list.
+    """
+    if no_install is None:
+        no_install = "--no-install" in sys.argv or bool(os.environ.get("RGBWATERMARK_NO_INSTALL"))
+
+    stamp_path = _stamp_path(required)
+    stamp = _read_stamp(stamp_path)
+    if stamp and stamp.get("site") == _site_directories():
+        return
+
+    names = [_split_requirement(requirement)[0] for requirement in required]
+    versions = {name: _installed_version(name) for name in names}
+    missing = [requirement for requirement in required if not _is_satisfied(requirement, versions)]
+
+    if missing:
+        if no_install:
+            sys.exit(f"Missing packages: {', '.join(sorted(missing))}")
+        subprocess.check_call([sys.executable, "-m", "pip", "install", *missing], stdout=subprocess.DEVNULL)
+        versions = {name: _installed_version(name) for name in names}
+
+    _write_stamp(stamp_path, {"executable": sys.executable, "versions": versions, "site": _site_directories()})
@@ -1,179 +1,557 @@
 import sys
-import subprocess
-import pkg_resources
+import bootstrap
 
 required = {"torch", "torchattacks", "torchvision", "numpy", "opencv-python", "Pillow", "tensorflow",
-            "realesrgan", "pandas", "transformers==4.16", "timm", "fairscale", "sentencepiece", "psutil"}
+            "realesrgan", "transformers==4.16", "timm", "fairscale", "sentencepiece", "psutil"}
 if sys.platform == "darwin":
     required.remove("tensorflow")
     required.add("tensorflow-macos")
     required.add("tensorflow-metal")
-installed = {pkg.key for pkg in pkg_resources.working_set}
-missing = required - installed
+bootstrap.ensure_requirements(required)
 
-if missing:
-    python = sys.executable
-    subprocess.check_call([python, "-m", "pip", "install", *missing], stdout=subprocess.DEVNULL)
-
-import torch
-import torchattacks
-from torchvision import transforms
+# torch, tensorflow, realesrgan and the model modules are imported where they are
+# used, so a run only pays for the models it selects
 import numpy as np
-import cv2
 from PIL import Image
-import tensorflow as tf
-from tensorflow.keras.models import load_model
-from realesrgan import RealESRGANer
-from realesrgan.archs.srvgg_arch import SRVGGNetCompact
-from torchvision.utils import save_image
-import models.deepbooru.deepbooru as deepbooru_module
-import models.blip.blip as blip_module
-import models.wdtagger.ASL as ASL
-import pandas as pd
 import math 
 import argparse
 import os
-
-for device in tf.config.experimental.list_physical_devices("GPU"):
-    tf.config.experimental.set_memory_growth(device, True)
+import threading
+import queue
+import json
+import time
+import contextlib
+import glob
+import csv
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 dirname = os.path.dirname(__file__)
 
-device = "mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu"
+device = None
+tensorflow_configured = False
 
-def resize(image, dim):
-    model_path = os.path.join(dirname, "models/upscaler.pt")
-    model = SRVGGNetCompact(upscale=4, num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, act_type="prelu")
-    upsampler = RealESRGANer(scale=4, model_path=model_path, model=model, tile=0, tile_pad=10, pre_pad=0, half=False)
-    img = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-    output, _ = upsampler.enhance(img, outscale=4)
-    output = cv2.resize(output, dim, interpolation=cv2.INTER_AREA)
-    return Image.fromarray(cv2.cvtColor(output, cv2.COLOR_BGR2RGB))
+def torch_device():
+    global device
+    if device is None:
+        import torch
+        device = "mps" if torch.backends.mps.is_available() else "cuda" if torch.cuda.is_available() else "cpu"
+    return device
 
-def load_deepbooru_image(image, dim):
-    global width 
-    global height
-    img = Image.open(image).convert("RGB")
-    width = img.width
-    height = img.height
-    img = img.resize((dim, dim), resample=Image.BICUBIC)
-    img = np.array(img)
-    img = img.astype(np.float32)
-    img = np.expand_dims(img, 0) / 255
-    return torch.from_numpy(img).to(device)
-
-def deepbooru(input, output, attack = "fgsm", epsilon = 10/255):
-    global model
-    model = deepbooru_module.DeepDanbooruModel()
-    model.load_state_dict(torch.load(os.path.join(dirname, "models/deepbooru/deepbooru.pt"), map_location="cpu"))
-    model.eval()
-    model.to(device)
-    img = load_deepbooru_image(input, 512)
-    atk = torchattacks.FGSM(model, eps=epsilon)
-    if attack == "pgd":
-        atk = torchattacks.PGD(model, eps=shift_epsilon(epsilon, 0.1))
-    elif attack == "mifgsm":
-        atk = torchattacks.MIFGSM(model, eps=epsilon)
-    probs = model(img)[0]
-    random_indices = torch.multinomial(probs, 1)
-    random_tensor = torch.nn.functional.one_hot(random_indices, num_classes=probs.shape[0])
-    adv_image = atk(img, random_tensor.float())
-    img2 = Image.fromarray((adv_image[0] * 255).cpu().numpy().astype(np.uint8))
-    img2 = resize(img2, (width, height))
-    img2.save(output)
-    return img2
-
-def predict_deepbooru(image):
+def import_tensorflow():
+    global tensorflow_configured
+    import tensorflow as tf
+    if not tensorflow_configured:
+        for gpu in tf.config.experimental.list_physical_devices("GPU"):
+            tf.config.experimental.set_memory_growth(gpu, True)
+        tensorflow_configured = True
+    return tf
+
+def model_size(model):
+    if hasattr(model, "parameters"):
+        tensors = list(model.parameters()) + list(model.buffers())
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+    if hasattr(model, "count_params"):
+        return model.count_params() * 4
+    if hasattr(model, "model"):
+        return model_size(model.model)
+    return 0
+
+class ModelRegistry(object):
+    """
+    Process-wide cache of loaded models, shared by the attack and predict paths.
+
+    Each model is loaded once on first use and kept resident. When budget (bytes) is set
+    and the loaded models go over it, the least recently used ones are evicted.
+    """
+    def __init__(self, budget=None):
+        self.budget = budget
+        self._loaders = {}
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, name, loader):
+        self._loaders[name] = loader
+
+    def get(self, name):
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                return self._models[name][0]
+            model = self._loaders[name]()
+            self._models[name] = (model, model_size(model))
+            self._evict()
+            return model
+
+    def _evict(self):
+        if self.budget is None:
+            return
+        # never evict the model that was just requested
+        while len(self._models) > 1 and sum(size for _, size in self._models.values()) > self.budget:
+            self._models.popitem(last=False)
+
+def load_deepbooru_model():
+    import torch
+    import models.deepbooru.deepbooru as deepbooru_module
     model = deepbooru_module.DeepDanbooruModel()
     model.load_state_dict(torch.load(os.path.join(dirname, "models/deepbooru/deepbooru.pt"), map_location="cpu"))
+    # an array so the tags of a whole row can be picked with one fancy index
+    model.tags = np.array(model.tags)
+    model.tag_index = {tag: i for i, tag in enumerate(model.tags)}
     model.eval()
-    model.to(device)
-    tags = []
-    with torch.no_grad():
-        probs = model(image)[0]
-    for i, p in enumerate(probs):
-        if p >= 0.5:
-            tags.append(model.tags[i])
-    return ", ".join(tags)
-
-def load_blip_image(image, dim):
-    global width 
-    global height
-    raw_image = Image.open(image).convert("RGB")
-    width, height = raw_image.size
-    transform = transforms.Compose([
-        transforms.Resize((dim, dim), interpolation=transforms.InterpolationMode.BICUBIC),
-        transforms.ToTensor()
-    ])
-    return transform(raw_image).unsqueeze(0).to(device)
-
-def blip(input, output, attack = "pgd", epsilon = 10/255):
-    global model
-    model = blip_module.blip_decoder(pretrained=os.path.join(dirname, "models/blip/blip.pt"), image_size=384, vit="base")
-    model.eval()
-    model.to(device)
-    img = load_blip_image(input, 384)
-    atk = torchattacks.PGD(model, eps=epsilon)
-    adv_image = atk(img, torch.tensor([1.0]))
-    save_image(adv_image[0], output)
-    img2 = Image.open(output)
-    img2 = resize(img2, (width, height))
-    img2.save(output)
-    return img2
-
-def predict_blip(image):
+    model.to(torch_device())
+    return model
+
+def load_blip_model():
+    import models.blip.blip as blip_module
     model = blip_module.blip_decoder(pretrained=os.path.join(dirname, "models/blip/blip.pt"), image_size=384, vit="base")
     model.eval()
-    model.to(device)
+    model.to(torch_device())
+    return model
+
+def load_wdtagger_model():
+    tf = import_tensorflow()
+    return tf.keras.models.load_model(os.path.join(dirname, "models/wdtagger/wdtagger"))
+
+def load_wdtagger_labels():
+    """
+    Reads selected_tags.csv into arrays of tag names and categories, in output order.
+    """
+    f = open(os.path.join(dirname, "models/wdtagger/selected_tags.csv"), "r", newline="", encoding="utf-8")
+    rows = list(csv.DictReader(f))
+    f.close()
+    names = np.array([row["name"] for row in rows])
+    categories = np.array([int(row["category"]) for row in rows], dtype=np.int8)
+    return names, categories
+
+# tile > 0 upscales in tiles of that size to bound memory, tile_pad overlaps them to hide seams.
+# mode is the resize policy, see resize_mode
+upscaler_options = {"tile": 0, "tile_pad": 10, "mode": "auto"}
+resize_modes = ["auto", "plain", "sr", "tiled"]
+default_sr_tile = 256
+# the upscaler model is a fixed 4x network
+sr_scale = 4
+# RealESRGANer keeps per-call state on the instance, so concurrent attacks take turns
+upscaler_lock = threading.Lock()
+
+def load_upscaler():
+    from realesrgan import RealESRGANer
+    from realesrgan.archs.srvgg_arch import SRVGGNetCompact
+    model_path = os.path.join(dirname, "models/upscaler.pt")
+    model = SRVGGNetCompact(upscale=sr_scale, num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, act_type="prelu")
+    return RealESRGANer(scale=sr_scale, model_path=model_path, model=model, tile=upscaler_options["tile"],
+                        tile_pad=upscaler_options["tile_pad"], pre_pad=0, half=False)
+
+registry = ModelRegistry()
+registry.register("deepbooru", load_deepbooru_model)
+registry.register("blip", load_blip_model)
+registry.register("wdtagger", load_wdtagger_model)
+registry.register("wdtagger_labels", load_wdtagger_labels)
+registry.register("upscaler", load_upscaler)
+
+def resize_mode(size, dim, mode="auto"):
+    """
+    Picks how to bring an image of size up to dim: "plain" Lanczos when it doesn't grow,
+    a single "sr" pass up to the 4x the upscaler produces and "tiled" sr beyond that.
+    """
+    if mode != "auto":
+        return mode
+    scale = max(dim[0] / size[0], dim[1] / size[1])
+    if scale <= 1:
+        return "plain"
+    if scale <= 4:
+        return "sr"
+    return "tiled"
+
+def upscale(image, mode):
+    """
+    Runs image through the 4x super-resolution model, returning the BGR array it produces.
+    """
+    import cv2
+    upsampler = registry.get("upscaler")
+    img = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
+    with upscaler_lock:
+        upsampler.tile_size = upscaler_options["tile"]
+        if mode == "tiled" and not upsampler.tile_size:
+            upsampler.tile_size = default_sr_tile
+        upsampler.tile_pad = upscaler_options["tile_pad"]
+        output, _ = upsampler.enhance(img, outscale=sr_scale)
+    return output
+
+def resize(image, dim, mode=None):
+    mode = resize_mode(image.size, dim, mode or upscaler_options["mode"])
+    if mode == "plain":
+        return image.resize(dim, resample=Image.LANCZOS)
+    import cv2
+    output = cv2.resize(upscale(image, mode), dim, interpolation=cv2.INTER_AREA)
+    return Image.fromarray(cv2.cvtColor(output, cv2.COLOR_BGR2RGB))
+
+def resize_band(image, dim, band=None, margin=8):
+    """
+    Resizes image to dim but only returns the rows band = (top, bottom) of the result.
+    Plain resizing samples exactly those rows through a fractional source box, super-resolution
+    upscales just the matching rows of image plus margin rows either side for context and then
+    applies the same row weights as resizing the whole upscaled image would.
+    """
+    if band is None:
+        return resize(image, dim)
+    width, height = dim
+    top, bottom = band
+    scale = image.height / height
+    mode = resize_mode(image.size, dim, upscaler_options["mode"])
+    if mode == "plain":
+        return image.resize((width, bottom - top), resample=Image.LANCZOS,
+                            box=(0, top * scale, image.width, bottom * scale))
+    import cv2
+    src_top = max(0, math.floor(top * scale) - margin)
+    src_bottom = min(image.height, math.ceil(bottom * scale) + margin)
+    output = upscale(image.crop((0, src_top, image.width, src_bottom)), mode).astype(np.float32)
+    # the final resize is separable, so resize the columns as resize() would and take the row
+    # weights resize() applies to the whole upscaled image, restricted to the upscaled band rows
+    output = cv2.resize(output, (width, output.shape[0]), interpolation=cv2.INTER_AREA)
+    rows = image.height * sr_scale
+    weights = cv2.resize(np.eye(rows, dtype=np.float32), (rows, height), interpolation=cv2.INTER_AREA)
+    weights = weights[top:bottom, src_top * sr_scale:src_bottom * sr_scale]
+    output = np.clip(np.rint(np.tensordot(weights, output, axes=1)), 0, 255).astype(np.uint8)
+    return Image.fromarray(cv2.cvtColor(output, cv2.COLOR_BGR2RGB))
+
+class ModelImage(object):
+    """
+    An image prepared for one model: the (1, ...) tensor it takes, and the size of the
+    image it was made from, which the adversarial image is resized back to.
+    """
+    def __init__(self, tensor, size):
+        self.tensor = tensor
+        self.width, self.height = size
+
+model_dims = {"deepbooru": 512, "wdtagger": 448, "blip": 384}
+# every model input is resized from one shared copy of the image that is at least this many
+# times their largest size, so big images are only scaled down in full once
+pyramid_gap = 3
+
+def preprocess_image(input, models):
+    """
+    Decodes input once and resizes it for each model, as float32 HWC arrays in [0, 1].
+    Returns the arrays by model name and the original size.
+    """
+    img = Image.open(input)
+    size = img.size
+    if models:
+        base = max(model_dims[name] for name in models) * pyramid_gap
+        # JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale when that still covers base
+        img.draft(None, (base, base))
+        img = img.convert("RGB")
+        factor = (max(1, img.width // base), max(1, img.height // base))
+        if factor != (1, 1):
+            img = img.reduce(factor)
+    arrays = {}
+    for name in models:
+        dim = model_dims[name]
+        resized = img.resize((dim, dim), resample=Image.BICUBIC)
+        arrays[name] = np.asarray(resized).astype(np.float32) / 255
+    return arrays, size
+
+def model_batch(name, arrays):
+    """
+    Stacks HWC arrays from preprocess_image into the batch the named model takes:
+    NHWC torch for deepbooru, NCHW torch for BLIP and NHWC NumPy for the WD tagger.
+    """
+    images = np.stack(arrays)
+    if name == "wdtagger":
+        return images
+    import torch
+    if name == "blip":
+        images = np.ascontiguousarray(images.transpose(0, 3, 1, 2))
+    return torch.from_numpy(images).to(torch_device())
+
+def load_model_images(input, models):
+    """
+    Decodes input once and prepares it for each of models, returning ModelImages by name.
+    """
+    arrays, size = preprocess_image(input, models)
+    return {name: ModelImage(model_batch(name, [arrays[name]]), size) for name in models}
+
+def load_deepbooru_image(image):
+    return load_model_images(image, ["deepbooru"])["deepbooru"]
+
+def deepbooru(input, output = None, attack = "fgsm", epsilon = 10/255, band = None, model = None):
+    img = input if isinstance(input, ModelImage) else load_deepbooru_image(input)
+    adv_images, steps = deepbooru_batch(img.tensor, attack, epsilon, model)
+    img2 = resize_band(Image.fromarray(adv_images[0]), (img.width, img.height), band)
+    if output:
+        img2.save(output)
+    return img2, steps[0]
+
+# steps is the step budget of the iterative attacks (PGD, MI-FGSM). With check_every > 0 they
+# check every that many steps whether each image already fools the model and stop early
+attack_options = {"steps": 10, "check_every": 0}
+
+def iterative_attack(loss, images, attack, epsilon, succeeded, steps, check_every, alpha=2/255, decay=1.0):
+    """
+    PGD (with a random start) or MI-FGSM on a batch, stepping like torchattacks but only
+    for the images still being attacked. loss(adv_images, index) and succeeded(adv_images, index)
+    get those images and their positions in the batch; succeeded returns a boolean tensor and
+    is asked every check_every steps. Returns the adversarial images and the steps each took.
+    """
+    import torch
+    adv_images = images.clone().detach()
+    if attack == "pgd":
+        adv_images = torch.clamp(adv_images + torch.empty_like(adv_images).uniform_(-epsilon, epsilon), 0, 1)
+    momentum = torch.zeros_like(images)
+    active = torch.arange(images.shape[0], device=images.device)
+    used = [steps] * images.shape[0]
+    for step in range(1, steps + 1):
+        adv = adv_images[active].requires_grad_(True)
+        grad = torch.autograd.grad(loss(adv, active), adv)[0]
+        if attack == "mifgsm":
+            grad = grad / torch.mean(torch.abs(grad), dim=(1, 2, 3), keepdim=True)
+            grad = grad + momentum[active] * decay
+            momentum[active] = grad
+        adv = adv.detach() + alpha * grad.sign()
+        delta = torch.clamp(adv - images[active], min=-epsilon, max=epsilon)
+        adv_images[active] = torch.clamp(images[active] + delta, min=0, max=1)
+        if check_every and step % check_every == 0 and step < steps:
+            with torch.no_grad():
+                done = succeeded(adv_images[active], active)
+            for index in active[done].tolist():
+                used[index] = step
+            active = active[~done]
+            if active.numel() == 0:
+                break
+    return adv_images.detach(), used
+
+def deepbooru_batch(images, attack = "fgsm", epsilon = 10/255, model = None):
+    """
+    Attacks a (N, 512, 512, 3) batch in [0, 1] with one forward/backward per step,
+    returning the adversarial images as uint8 arrays and the steps each took.
+
+    With early stopping the target is one of the tags the image has, and an image is done
+    once that tag drops below the deepbooru threshold.
+    """
+    import torch
+    import torchattacks
+    if model is None:
+        model = registry.get("deepbooru")
+    steps = attack_options["steps"]
+    early_stop = attack_options["check_every"] and attack in ("pgd", "mifgsm")
+    if attack == "pgd":
+        epsilon = shift_epsilon(epsilon, 0.1)
+    with torch.no_grad():
+        probs = model(images)
+    weights = probs
+    if early_stop:
+        present = probs >= deepbooru_options["threshold"]
+        weights = torch.where(present.any(dim=1, keepdim=True), probs * present, probs)
+    random_indices = torch.multinomial(weights, 1)[:, 0]
+    random_tensor = torch.nn.functional.one_hot(random_indices, num_classes=probs.shape[1]).float()
+
+    if early_stop:
+        def loss(adv_images, index):
+            return torch.nn.functional.cross_entropy(model(adv_images), random_tensor[index])
+
+        def succeeded(adv_images, index):
+            target_probs = model(adv_images).gather(1, random_indices[index, None])[:, 0]
+            return target_probs < deepbooru_options["threshold"]
+
+        adv_images, used = iterative_attack(loss, images, attack, epsilon, succeeded, steps, attack_options["check_every"])
+    else:
+        atk = torchattacks.FGSM(model, eps=epsilon)
+        used = [1] * images.shape[0]
+        if attack == "pgd":
+            atk = torchattacks.PGD(model, eps=epsilon, steps=steps)
+            used = [steps] * images.shape[0]
+        elif attack == "mifgsm":
+            atk = torchattacks.MIFGSM(model, eps=epsilon, steps=steps)
+            used = [steps] * images.shape[0]
+        adv_images = atk(images, random_tensor)
+    return list((adv_images * 255).cpu().numpy().astype(np.uint8)), used
+
+# threshold applies to every tag unless tag_thresholds (tag -> threshold) overrides it,
+# top_k > 0 keeps at most that many of the most likely tags per image
+deepbooru_options = {"threshold": 0.5, "top_k": 0, "tag_thresholds": {}}
+
+def deepbooru_thresholds(model, threshold, tag_thresholds):
+    thresholds = np.full(len(model.tags), threshold, dtype=np.float32)
+    for tag, tag_threshold in tag_thresholds.items():
+        if tag in model.tag_index:
+            thresholds[model.tag_index[tag]] = tag_threshold
+    return thresholds
+
+def select_tags(probs, thresholds, top_k=0):
+    """
+    Thresholds a (N, C) tensor of probabilities against a scalar or (C,) thresholds in one op,
+    optionally keeping only the top_k most likely tags per row. Returns a (N, C) boolean array.
+    """
+    import torch
+    thresholds = torch.as_tensor(thresholds, dtype=probs.dtype, device=probs.device)
+    mask = probs >= thresholds
+    if top_k:
+        _, indices = torch.topk(probs, min(top_k, probs.shape[1]), dim=1)
+        mask &= torch.zeros_like(mask).scatter_(1, indices, True)
+    return mask.cpu().numpy()
+
+def predict_deepbooru(image, model=None):
+    return predict_deepbooru_batch(image.tensor, model=model)[0]
+
+def predict_deepbooru_batch(images, threshold=None, top_k=None, tag_thresholds=None, model=None):
+    import torch
+    if model is None:
+        model = registry.get("deepbooru")
+    threshold = deepbooru_options["threshold"] if threshold is None else threshold
+    top_k = deepbooru_options["top_k"] if top_k is None else top_k
+    tag_thresholds = deepbooru_options["tag_thresholds"] if tag_thresholds is None else tag_thresholds
+    if tag_thresholds:
+        threshold = deepbooru_thresholds(model, threshold, tag_thresholds)
+    with torch.no_grad():
+        probs = model(images)
+    mask = select_tags(probs, threshold, top_k)
+    return [", ".join(model.tags[row]) for row in mask]
+
+def load_blip_image(image):
+    return load_model_images(image, ["blip"])["blip"]
+
+def blip(input, output = None, attack = "pgd", epsilon = 10/255, band = None, model = None):
+    img = input if isinstance(input, ModelImage) else load_blip_image(input)
+    adv_images, steps = blip_batch(img.tensor, attack, epsilon, model)
+    img2 = resize_band(Image.fromarray(adv_images[0]), (img.width, img.height), band)
+    if output:
+        img2.save(output)
+    return img2, steps[0]
+
+def blip_batch(images, attack = "pgd", epsilon = 10/255, model = None):
+    """
+    PGD on a (N, 3, 384, 384) batch in [0, 1] with one forward/backward per step,
+    returning the adversarial images as uint8 HWC arrays and the steps each took.
+
+    With early stopping the loss is the caption model's loss on the image's own caption,
+    and an image is done once the generated caption changes.
+    """
+    import torch
+    import torchattacks
+
+    class CaptionLoss(torch.nn.Module):
+        # BLIP's forward takes one caption per image
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, images):
+            return self.model(images, [""] * images.shape[0])
+
+    if model is None:
+        model = registry.get("blip")
+    steps = attack_options["steps"]
+    if attack_options["check_every"]:
+        with torch.no_grad():
+            captions = model.generate(images)
+
+        def loss(adv_images, index):
+            # generate strips the prompt, forward expects it and masks it out of the loss
+            return model(adv_images, [model.prompt + captions[i] for i in index.tolist()])[0]
+
+        def succeeded(adv_images, index):
+            changed = [caption != captions[i] for caption, i in zip(model.generate(adv_images), index.tolist())]
+            return torch.tensor(changed, device=adv_images.device)
+
+        adv_images, used = iterative_attack(loss, images, "pgd", epsilon, succeeded, steps, attack_options["check_every"])
+    else:
+        atk = torchattacks.PGD(CaptionLoss(model), eps=epsilon, steps=steps)
+        adv_images = atk(images, torch.tensor([1.0]))
+        used = [steps] * images.shape[0]
+    # round like torchvision's save_image
+    adv_images = adv_images.mul(255).add_(0.5).clamp_(0, 255).permute(0, 2, 3, 1)
+    return list(adv_images.to("cpu", torch.uint8).numpy()), used
+
+def predict_blip(image, model=None):
+    return predict_blip_batch(image.tensor, model)[0]
+
+def predict_blip_batch(images, model=None):
+    import torch
+    if model is None:
+        model = registry.get("blip")
     with torch.no_grad():
-        caption = model.generate(image)
-        return caption[0]
-
-def load_wdtagger_image(image, dim):
-    global width 
-    global height
-    img = Image.open(image).convert("RGB")
-    width = img.width
-    height = img.height
-    img = img.resize((dim, dim), resample=Image.BICUBIC)
-    img = np.array(img)
-    img = img.astype(np.float32)
-    img = np.expand_dims(img, 0) / 255
-    return tf.convert_to_tensor(img)
-
-def wdtagger(input, output, attack = "fgsm", epsilon = 10/255):
-    global model 
-    model = load_model(os.path.join(dirname, "models/wdtagger/wdtagger"))
-    img = load_wdtagger_image(input, 448)
-    probs = model.predict(img)
-    target_class = np.random.randint(probs.shape[-1])
-    label = tf.one_hot(target_class, probs.shape[-1])
+        return model.generate(images)
+
+def load_wdtagger_image(image):
+    return load_model_images(image, ["wdtagger"])["wdtagger"]
+
+def wdtagger(input, output = None, attack = "fgsm", epsilon = 10/255, band = None, model = None):
+    img = input if isinstance(input, ModelImage) else load_wdtagger_image(input)
+    adv_images, steps = wdtagger_batch(img.tensor, attack, epsilon, model)
+    img2 = resize_band(Image.fromarray(adv_images[0]), (img.width, img.height), band)
+    if output:
+        img2.save(output)
+    return img2, steps[0]
+
+def wdtagger_batch(images, attack = "fgsm", epsilon = 10/255, model = None):
+    """
+    FGSM on a (N, 448, 448, 3) batch in [0, 1] with one forward/backward,
+    returning the adversarial images as uint8 arrays and the steps each took (always 1).
+    """
+    tf = import_tensorflow()
+    import models.wdtagger.ASL as ASL
+    if model is None:
+        model = registry.get("wdtagger")
+    images = tf.convert_to_tensor(images)
     with tf.GradientTape() as tape:
-        tape.watch(img)
-        prediction = model(img)
+        tape.watch(images)
+        prediction = model(images)
+        target_classes = np.random.randint(prediction.shape[-1], size=prediction.shape[0])
+        label = tf.one_hot(target_classes, prediction.shape[-1])
         loss_object = ASL.AsymmetricLoss()
         loss = loss_object(label, prediction)
-    gradient = tape.gradient(loss, img)
+    gradient = tape.gradient(loss, images)
     perturbations = tf.sign(gradient)
-    adv_img = img + epsilon * perturbations
-    adv_img = tf.clip_by_value(adv_img, 0.0, 1.0)
-    adv_img *= 255.0
-    tf.keras.utils.save_img(output, tf.squeeze(adv_img))
-    img2 = Image.open(output)
-    img2 = resize(img2, (width, height))
-    img2.save(output)
-    return img2
-
-def predict_wdtagger(image, thresh = 0.3228):
-    model = load_model(os.path.join(dirname, "models/wdtagger/wdtagger"))
-    label_names = pd.read_csv(os.path.join(dirname, "models/wdtagger/selected_tags.csv"))
-    probs = model.predict(image * 255)
-    label_names["probs"] = probs[0]
-    found_tags = label_names[label_names["probs"] > thresh]
-    return ", ".join(found_tags["name"])
-
-def combine_images(images, output):
+    adv_imgs = images + epsilon * perturbations
+    adv_imgs = tf.clip_by_value(adv_imgs, 0.0, 1.0)
+    adv_imgs *= 255.0
+    # array_to_img rescales to the full range, as save_img did
+    return [np.asarray(tf.keras.utils.array_to_img(adv_img)) for adv_img in adv_imgs], [1] * len(adv_imgs)
+
+# category_thresholds (category -> threshold) overrides threshold for the tags of a
+# category: 0 general, 4 character, 9 rating in selected_tags.csv
+wdtagger_options = {"threshold": 0.3228, "category_thresholds": {}}
+
+def wdtagger_thresholds(categories, thresh, category_thresholds):
+    thresholds = np.full(len(categories), thresh, dtype=np.float32)
+    for category, category_threshold in category_thresholds.items():
+        thresholds[categories == category] = category_threshold
+    return thresholds
+
+def predict_wdtagger(image, thresh = None, model = None):
+    return predict_wdtagger_batch(image.tensor, thresh, model=model)[0]
+
+def predict_wdtagger_batch(images, thresh = None, category_thresholds = None, model = None):
+    if model is None:
+        model = registry.get("wdtagger")
+    names, categories = registry.get("wdtagger_labels")
+    thresh = wdtagger_options["threshold"] if thresh is None else thresh
+    category_thresholds = wdtagger_options["category_thresholds"] if category_thresholds is None else category_thresholds
+    if category_thresholds:
+        thresh = wdtagger_thresholds(categories, thresh, category_thresholds)
+    probs = model.predict(images * 255)
+    return [", ".join(names[row]) for row in probs > thresh]
+
+def image_bands(height, count):
+    """
+    The (top, bottom) rows of the horizontal bands combine_images takes from each of count
+    images. Very short images get fewer than count bands.
+    """
+    y_inc = math.ceil(height / count)
+    return [(top, min(top + y_inc, height)) for top in range(0, height, y_inc)]
+
+def combine_images(images, output, bands=None):
+    """
+    Stacks one horizontal band of each image. With bands, images are the bands themselves,
+    already cut out as by resize_band.
+    """
     width = images[0].width 
+    if bands is not None:
+        new_image = Image.new("RGB", (width, bands[-1][1]))
+        for image, (top, _) in zip(images, bands):
+            new_image.paste(image, (0, top))
+        new_image.save(output)
+        return
     height = images[0].height
     new_image = Image.new("RGB", (width, height))
     y_offset = 0
@@ -193,6 +571,229 @@ def shift_epsilon(epsilon, shift):
     return new_epsilon
 
 
+def run_concurrently(jobs):
+    """
+    Runs each callable in jobs on its own thread and returns their results in order.
+    torch and TensorFlow release the GIL while they compute, so the attacks overlap.
+    """
+    if len(jobs) == 1:
+        return [jobs[0]()]
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = [executor.submit(job) for job in jobs]
+        return [future.result() for future in futures]
+
+# how much each model's epsilon is shifted from the requested one, in composite order
+epsilon_shifts = {"deepbooru": 0, "blip": 0.1, "wdtagger": -0.05}
+
+def attack_image(input, output, models, attack="fgsm", epsilon=10/255):
+    """
+    Attacks input with every model at once, keeping the adversarial images in memory,
+    and writes only the composite to output. Each model's image is only resized back up
+    for the band it contributes to the composite. Returns the attack steps each model took.
+    """
+    attacks = {"deepbooru": deepbooru, "blip": blip, "wdtagger": wdtagger}
+    names = [name for name in epsilon_shifts if name in models]
+    images = load_model_images(input, names)
+    bands = image_bands(images[names[0]].height, len(names))
+    jobs = [lambda name=name, band=band: attacks[name](images[name], None, attack, shift_epsilon(epsilon, epsilon_shifts[name]), band)
+            for name, band in zip(names, bands)]
+    results = run_concurrently(jobs)
+    combine_images([image for image, _ in results], output, bands)
+    return {name: steps for name, (_, steps) in zip(names, results)}
+
+def predict_image(input, output, models):
+    text = []
+    images = load_model_images(input, [name for name in model_dims if name in models])
+    if "deepbooru" in models:
+        tags = predict_deepbooru(images["deepbooru"])
+        text.append("DeepBooru:")
+        text.append(tags)
+    if "wdtagger" in models:
+        tags = predict_wdtagger(images["wdtagger"])
+        text.append("WDTagger:")
+        text.append(tags)
+    if "blip" in models:
+        tags = predict_blip(images["blip"])
+        text.append("BLIP:")
+        text.append(tags)
+    text = "\n".join(text)
+    if output:
+        f = open(output, "w")
+        f.write(text)
+        f.close()
+    return text
+
+image_extensions = {".png", ".jpg", ".jpeg", ".webp", ".bmp"}
+
+def batch_inputs(input):
+    if os.path.isdir(input):
+        files = [os.path.join(input, f) for f in os.listdir(input)]
+    else:
+        files = glob.glob(input)
+    return sorted(f for f in files if os.path.splitext(f)[1].lower() in image_extensions)
+
+def load_batches(files, models, batch_size, batches):
+    """
+    Runs in a background thread, putting lists of (file, arrays, size, error) on the batches
+    queue and None once every file has been read.
+    """
+    batch = []
+    for file in files:
+        try:
+            arrays, size = preprocess_image(file, models)
+            batch.append((file, arrays, size, None))
+        except Exception as e:
+            batch.append((file, None, None, str(e)))
+        if len(batch) == batch_size:
+            batches.put(batch)
+            batch = []
+    if batch:
+        batches.put(batch)
+    batches.put(None)
+
+def predict_batch(input, output, models, batch_size=8):
+    """
+    Predicts every image in a directory (or matching a glob) in batches of batch_size,
+    decoding the next batch in the background, and streams one JSON line per image to output.
+    """
+    files = batch_inputs(input)
+    batches = queue.Queue(maxsize=2)
+    threading.Thread(target=load_batches, args=(files, models, batch_size, batches), daemon=True).start()
+
+    f = open(output, "w")
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        loaded = [(file, arrays) for file, arrays, _, error in batch if error is None]
+        results = {file: {"file": file} for file, _, _, _ in batch}
+        for file, _, _, error in batch:
+            if error is not None:
+                results[file]["error"] = error
+
+        if loaded:
+            start_time = time.time()
+            if "deepbooru" in models:
+                images = model_batch("deepbooru", [arrays["deepbooru"] for _, arrays in loaded])
+                for (file, _), tags in zip(loaded, predict_deepbooru_batch(images)):
+                    results[file]["deepbooru"] = tags
+            if "wdtagger" in models:
+                images = model_batch("wdtagger", [arrays["wdtagger"] for _, arrays in loaded])
+                for (file, _), tags in zip(loaded, predict_wdtagger_batch(images)):
+                    results[file]["wdtagger"] = tags
+            if "blip" in models:
+                images = model_batch("blip", [arrays["blip"] for _, arrays in loaded])
+                for (file, _), caption in zip(loaded, predict_blip_batch(images)):
+                    results[file]["blip"] = caption
+            batch_time = (time.time() - start_time) / len(loaded)
+            for file, _ in loaded:
+                results[file]["time"] = batch_time
+
+        for file, _, _, _ in batch:
+            f.write(json.dumps(results[file]) + "\n")
+        f.flush()
+    f.close()
+
+def attack_batch(input, output, models, attack="fgsm", epsilon=10/255, batch_size=4):
+    """
+    Attacks every image in a directory (or matching a glob) in batches of batch_size,
+    one forward/backward per attack step for the whole batch, and writes each composite
+    under its original name into the output directory.
+    """
+    files = batch_inputs(input)
+    os.makedirs(output, exist_ok=True)
+    batches = queue.Queue(maxsize=2)
+    threading.Thread(target=load_batches, args=(files, models, batch_size, batches), daemon=True).start()
+
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        for file, _, _, error in batch:
+            if error is not None:
+                print(f"{file}: {error}", file=sys.stderr)
+        loaded = [(file, arrays, size) for file, arrays, size, error in batch if error is None]
+        if not loaded:
+            continue
+
+        attacks = {"deepbooru": deepbooru_batch, "blip": blip_batch, "wdtagger": wdtagger_batch}
+        jobs = []
+        for name in epsilon_shifts:
+            if name in models:
+                images = model_batch(name, [arrays[name] for _, arrays, _ in loaded])
+                jobs.append(lambda name=name, images=images: attacks[name](images, attack, shift_epsilon(epsilon, epsilon_shifts[name])))
+        adversarial = run_concurrently(jobs)
+
+        for i, (file, _, size) in enumerate(loaded):
+            bands = image_bands(size[1], len(adversarial))
+            images = [resize_band(Image.fromarray(adv_images[i]), size, band) for (adv_images, _), band in zip(adversarial, bands)]
+            combine_images(images, os.path.join(output, os.path.basename(file)), bands)
+            if attack_options["check_every"]:
+                names = [name for name in epsilon_shifts if name in models]
+                steps = {name: used[i] for name, (_, used) in zip(names, adversarial)}
+                print(json.dumps({"file": file, "steps": steps}))
+
+def serve(preload=[], workers=1):
+    """
+    Keeps models warm and processes jobs from stdin, one JSON object per line, until EOF.
+
+    {"id": 1, "mode": "predict", "input": "in.png", "output": "tags.txt", "models": ["deepbooru", "blip"]}
+    {"id": 2, "mode": "attack", "input": "in.png", "output": "out.png", "models": ["wdtagger"], "attack": "pgd", "epsilon": 0.04}
+
+    Jobs are queued as they arrive and run on up to workers threads, so with more than one
+    worker responses can come back out of order. Each gets one JSON line back on stdout with
+    its id, a status of "ok" or "error", the time it spent queued and the time it took to run.
+    Predict jobs also return the predicted text, attack jobs the attack steps each model took.
+    """
+    out = sys.stdout
+    out_lock = threading.Lock()
+    jobs = queue.Queue()
+
+    def read_jobs():
+        for line in sys.stdin:
+            line = line.strip()
+            if line:
+                jobs.put((line, time.time()))
+        jobs.put(None)
+
+    threading.Thread(target=read_jobs, daemon=True).start()
+
+    def run_job(line, received_time):
+        start_time = time.time()
+        job = {}
+        try:
+            job = json.loads(line)
+            mode = job.get("mode")
+            models = job.get("models", [])
+            if mode == "predict":
+                text = predict_image(job.get("input"), job.get("output"), models)
+                response = {"status": "ok", "text": text}
+            elif mode == "attack":
+                epsilon = float(job["epsilon"]) if job.get("epsilon") else 10/255
+                steps = attack_image(job.get("input"), job.get("output"), models, job.get("attack") or "fgsm", epsilon)
+                response = {"status": "ok", "steps": steps}
+            else:
+                raise ValueError(f"Unknown mode: {mode}")
+        except Exception as e:
+            response = {"status": "error", "error": str(e)}
+        response["id"] = job.get("id") if isinstance(job, dict) else None
+        response["queue_time"] = start_time - received_time
+        response["time"] = time.time() - start_time
+        with out_lock:
+            out.write(json.dumps(response) + "\n")
+            out.flush()
+
+    # keep model loading chatter off the protocol stream, preloading included; redirect_stdout
+    # swaps sys.stdout for the whole process, so it is done once around every worker
+    with contextlib.redirect_stdout(sys.stderr), ThreadPoolExecutor(max_workers=workers) as executor:
+        for name in preload:
+            registry.get(name)
+        while True:
+            item = jobs.get()
+            if item is None:
+                break
+            executor.submit(run_job, *item)
+
 def main():
     parser = argparse.ArgumentParser(prog="CLIP Breaker")
     parser.add_argument("-m", "--mode")
@@ -203,39 +804,75 @@ def main():
     parser.add_argument("-w", "--wdtagger", action="store_true")
     parser.add_argument("-a", "--attack")
     parser.add_argument("-e", "--epsilon")
+    parser.add_argument("--model-budget")
+    parser.add_argument("--tile")
+    parser.add_argument("--tile-pad")
+    parser.add_argument("--resize", choices=resize_modes)
+    parser.add_argument("--batch-size")
+    parser.add_argument("--deepbooru-threshold")
+    parser.add_argument("--deepbooru-top-k")
+    parser.add_argument("--deepbooru-tag-thresholds")
+    parser.add_argument("--wdtagger-threshold")
+    parser.add_argument("--wdtagger-category-thresholds")
+    parser.add_argument("--steps")
+    parser.add_argument("--check-every")
+    parser.add_argument("--serve", action="store_true")
+    parser.add_argument("--workers")
+    parser.add_argument("--no-install", action="store_true")
     args = parser.parse_args()
 
+    if args.tile:
+        upscaler_options["tile"] = int(args.tile)
+    if args.tile_pad:
+        upscaler_options["tile_pad"] = int(args.tile_pad)
+    if args.resize:
+        upscaler_options["mode"] = args.resize
+
+    if args.deepbooru_threshold:
+        deepbooru_options["threshold"] = float(args.deepbooru_threshold)
+    if args.deepbooru_top_k:
+        deepbooru_options["top_k"] = int(args.deepbooru_top_k)
+    if args.deepbooru_tag_thresholds:
+        # a JSON object of tag -> threshold
+        f = open(args.deepbooru_tag_thresholds, "r")
+        deepbooru_options["tag_thresholds"] = json.load(f)
+        f.close()
+
+    if args.wdtagger_threshold:
+        wdtagger_options["threshold"] = float(args.wdtagger_threshold)
+    if args.wdtagger_category_thresholds:
+        # category=threshold pairs, e.g. 4=0.85,9=0.5
+        for pair in args.wdtagger_category_thresholds.split(","):
+            category, threshold = pair.split("=")
+            wdtagger_options["category_thresholds"][int(category)] = float(threshold)
+
+    if args.steps:
+        attack_options["steps"] = int(args.steps)
+    if args.check_every:
+        attack_options["check_every"] = int(args.check_every)
+
+    if args.model_budget:
+        registry.budget = float(args.model_budget) * 1024 * 1024
+
     attack = args.attack if args.attack else "fgsm"
     epsilon = float(args.epsilon) if args.epsilon else 10/255
+    models = [name for name in ("deepbooru", "blip", "wdtagger") if getattr(args, name)]
 
-    if args.mode == "attack":
-        images = []
-        if args.deepbooru:
-            img = deepbooru(args.input, args.output, attack, epsilon)
-            images.append(img)
-        if args.blip:
-            img = blip(args.input, args.output, attack, shift_epsilon(epsilon, 0.1))
-            images.append(img)
-        if args.wdtagger:
-            img = wdtagger(args.input, args.output, attack, shift_epsilon(epsilon, -0.05))
-            images.append(img)
-        combine_images(images, args.output)
+    if args.serve:
+        # models selected on the command line are loaded up front
+        serve(models, int(args.workers) if args.workers else 1)
+    elif args.mode == "attack":
+        steps = attack_image(args.input, args.output, models, attack, epsilon)
+        if attack_options["check_every"]:
+            print(json.dumps({"steps": steps}))
     elif args.mode == "predict":
-        text = []
-        if args.deepbooru:
-            tags = predict_deepbooru(load_deepbooru_image(args.input, 512))
-            text.append("DeepBooru:")
-            text.append(tags)
-        if args.wdtagger:
-            tags = predict_wdtagger(load_wdtagger_image(args.input, 448))
-            text.append("WDTagger:")
-            text.append(tags)
-        if args.blip:
-            tags = predict_blip(load_blip_image(args.input, 384))
-            text.append("BLIP:")
-            text.append(tags)
-        f = open(args.output, "w")
-        f.write("\n".join(text))
+        predict_image(args.input, args.output, models)
+    elif args.mode == "attack-batch":
+        batch_size = int(args.batch_size) if args.batch_size else 4
+        attack_batch(args.input, args.output, models, attack, epsilon, batch_size)
+    elif args.mode == "predict-batch":
+        batch_size = int(args.batch_size) if args.batch_size else 8
+        predict_batch(args.input, args.output, models, batch_size)
         
 if __name__ == "__main__":
     main()
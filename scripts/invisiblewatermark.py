@@ -1,18 +1,16 @@
 import sys
-import subprocess
-import pkg_resources
+import bootstrap
 
-required = {"opencv-python", "Pillow", "PyWavelets", "numpy"}
-installed = {pkg.key for pkg in pkg_resources.working_set}
-missing = required - installed
-
-if missing:
-    python = sys.executable
-    subprocess.check_call([python, "-m", "pip", "install", *missing], stdout=subprocess.DEVNULL)
+bootstrap.ensure_requirements({"opencv-python", "Pillow", "PyWavelets", "numpy"})
 
 import argparse
 import pathlib
 import io
+import json
+import contextlib
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 import numpy as np
 import io
@@ -30,6 +28,7 @@ def subsample(
     u=True,
     v=False,
     subsample_type: SubsampleOptions = SubsampleOptions.FOUR_TWO_ZERO,
+    copy=True,
   ):
   if subsample_type == SubsampleOptions.FOUR_FOUR_TWO:
     return ValueError("Not yet implemented")
@@ -40,15 +39,11 @@ def subsample(
   if v:
     channels.append(2)
 
-  subsampled_image = yuv_img.copy()
+  subsampled_image = yuv_img.copy() if copy else yuv_img
   cols, rows, _ = yuv_img.shape
   for channel in channels:
 
     # Horizontal copy
-    print("~~~~ Horizontal ~~~~~")
-    print(subsampled_image[:, :, channel].shape)
-    print(subsampled_image[:, 1:rows // 2 * 2:2, channel].shape)
-    print(subsampled_image[:, ::2, channel].shape)
     last_source_row = rows // 2 * 2
     subsampled_image[:, 1::2, channel] = subsampled_image[:,
                                                           :last_source_row:2, channel]
@@ -57,100 +52,207 @@ def subsample(
     #   continue
 
     # Vertical copy
-    print("~~~~ Vertical ~~~~~")
-    print(subsampled_image[1::2, :, channel].shape)
-    print(subsampled_image[::2, :, channel].shape)
     last_source_col = cols // 2 * 2
     subsampled_image[1::2, :,
                      channel] = subsampled_image[:last_source_col:2, :, channel]
 
   return subsampled_image
 
-def rgb_to_yuv(rgb: np.ndarray) -> np.ndarray:
+# Conversions run a chunk of rows at a time, and elements of the dtype result this close to a
+# .5 tie are recomputed in float64, where the rounding could otherwise go the other way
+CONVERT_ROWS = 256
+TIE_TOLERANCE = 1e-3
+
+def _convert(source: np.ndarray, m: np.ndarray, before: np.ndarray, after: np.ndarray,
+             out: np.ndarray, dtype) -> np.ndarray:
+  '''
+  (source + before) @ m + after, clipped to 0-255 and rounded, computed in dtype
+
+  Elements near a .5 tie are redone with the float64 np.dot the conversion
+  originally used, so the result is identical to the float64 path
+  '''
+  rows, columns, _ = source.shape
+  if out is None:
+    out = np.empty((rows, columns, m.shape[1]), dtype=dtype)
+  aliased = np.shares_memory(source, out)
+  m_dtype = m.astype(dtype)
+  # the offsets folded into one per plane, added plane by plane as that is much
+  # faster than broadcasting over the short last axis
+  bias = (before @ m + after).astype(dtype)
+  scratch = np.empty((min(rows, CONVERT_ROWS), columns, m.shape[1]), dtype=dtype)
+
+  for top in range(0, rows, CONVERT_ROWS):
+    src = source[top:top + CONVERT_ROWS]
+    if aliased:
+      src = src.copy()
+    unrounded = np.matmul(src.astype(dtype), m_dtype, out=scratch[:src.shape[0]])
+    for plane, offset in enumerate(bias):
+      if offset:
+        unrounded[:, :, plane] += offset
+    np.clip(unrounded, 0, 255, out=unrounded)
+    result = np.round(unrounded, out=out[top:top + CONVERT_ROWS])
+
+    # distance from the rounded value, ties are close to 0.5
+    np.subtract(unrounded, result, out=unrounded)
+    np.abs(unrounded, out=unrounded)
+    ties = np.flatnonzero(unrounded > 0.5 - TIE_TOLERANCE)
+    if ties.size:
+      tie_rows, tie_cols, tie_planes = np.unravel_index(ties, result.shape)
+      pixels = src[tie_rows, tie_cols].astype(np.float64)[:, None, :] + before
+      exact = np.dot(pixels, m)[:, 0, :] + after
+      exact = exact[np.arange(ties.size), tie_planes]
+      result[tie_rows, tie_cols, tie_planes] = np.round(np.clip(exact, 0, 255))
+  return out
+
+def rgb_to_yuv(rgb: np.ndarray, out: np.ndarray = None, dtype=np.float32,
+               channels=[0, 1, 2]) -> np.ndarray:
+  '''
+  Converts to YUV rounded to whole values, computed in dtype
+
+  Only the planes listed in channels are computed, in that order. out can be
+  a preallocated (rows, columns, len(channels)) array of dtype to write into
+  '''
   m = np.array([
       [0.29900, -0.14713, 0.615],
       [0.58700, -0.28886, -0.51499],
       [0.11400, 0.436, -0.10001]
     ])
+  offsets = np.array([0, 127.5, 127.5])
+
+  return _convert(rgb, m[:, channels], np.zeros(3), offsets[channels], out, dtype)
 
-  # rgb = rgb.astype(float)
-  yuv = np.dot(rgb, m)
-  yuv[:, :, 1:] += 127.5
-  yuv = np.clip(yuv, 0, 255)
-  # return yuv
-  return np.round(yuv).astype(int)
 
+def yuv_to_rgb(yuv: np.ndarray, out: np.ndarray = None, dtype=np.float32) -> np.ndarray:
+  '''
+  Converts to RGB rounded to whole values, computed in dtype
 
-def yuv_to_rgb(yuv: np.ndarray) -> np.ndarray:
-  yuv = yuv.astype(float)
+  out can be a preallocated (rows, columns, 3) array of dtype to write into,
+  including yuv itself
+  '''
   m = np.array([
       [1.000, 1.000, 1.000],
       [0.000, -0.39465, 2.03211],
       [1.13983, -0.58060, 0.000],
     ])
 
-  yuv[:, :, 1:] -= 127.5
-  rgb = np.dot(yuv, m)
-  rgb = np.clip(rgb, 0, 255)
-  return np.round(rgb).astype(int)
+  return _convert(yuv, m, np.array([0, -127.5, -127.5]), np.zeros(3), out, dtype)
+
+
+# Images above this many pixels are watermarked in horizontal strips
+MAX_FRAME_PIXELS = 4096 * 4096
+STRIP_ROWS = 512
+# Inputs are local files, so PIL's decompression bomb guard (about 179 MP) is raised to
+# what the whole uint8 frame can reasonably take in memory: 1 GP, 3 GB as RGB
+MAX_IMAGE_PIXELS = 32768 * 32768
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+def _strips(rows: int, columns: int, block: int, strip_rows: int):
+  '''
+  Split rows into horizontal strips of about strip_rows rows
+
+  Strips are aligned to 2 * block image rows (one block of the Haar
+  approximation band), so the transform and the blocks of each strip are
+  exactly those of the whole image. Yields (top, bottom, start) where start
+  is the index of the first block of the strip in whole-image block order,
+  or the whole image as one strip when strip_rows is None
+  '''
+  if strip_rows is None:
+    yield 0, rows, 0
+    return
+
+  step = max(strip_rows // (2 * block), 1) * 2 * block
+  blocks_per_row = (columns // block * block // 2) // block
+  for top in range(0, rows, step):
+    yield top, min(top + step, rows), top // (2 * block) * blocks_per_row
+
+
+def _max_dct_coefficients(frame: np.ndarray, block: int):
+  '''
+  Locate the largest non-DC coefficient of every block x block tile of frame
+
+  Returns the (row, col) indices into frame as two arrays shaped
+  (M // block, N // block), so tiles are visited in the same row-major order
+  as the per-block loop
+  '''
+  (row, col) = frame.shape
+  row_blocks, col_blocks = row // block, col // block
+
+  blocks = frame[:row_blocks * block, :col_blocks * block]
+  blocks = blocks.reshape(row_blocks, block, col_blocks, block).swapaxes(1, 2)
+  blocks = blocks.reshape(row_blocks, col_blocks, block * block)
+
+  pos = np.argmax(abs(blocks[:, :, 1:]), axis=2) + 1
+  rows = np.arange(row_blocks)[:, None] * block + pos // block
+  cols = np.arange(col_blocks)[None, :] * block + pos % block
+  return rows, cols
 
 
 class EmbedMaxDct(object):
-  def __init__(self, watermarks=[], scales=[0, 36, 36], block=4):
+  def __init__(self, watermarks=[], scales=[0, 36, 36], block=4, channels=[0, 1]):
     self._watermarks = watermarks
     self._wmLen = len(watermarks)
     self._scales = scales
     self._block = block
+    # only planes with a positive scale carry payload
+    self._channels = [channel for channel in channels if scales[channel] > 0]
+
+  def encode_rgb(self, rgb: np.ndarray, strip_rows: int = None) -> np.ndarray:
+    '''
+    With strip_rows the image is encoded strip by strip and written back into
+    rgb, which must be a writable uint8 array, so only one strip is ever held
+    in floating point
+    '''
+    if strip_rows is None:
+      return self._encode_strip(rgb)
 
-  def encode_rgb(self, rgb: np.ndarray) -> np.ndarray:
+    rows, columns, _ = rgb.shape
+    for top, bottom, start in _strips(rows, columns, self._block, strip_rows):
+      rgb[top:bottom] = self._encode_strip(rgb[top:bottom], start)
+    return rgb
+
+  def _encode_strip(self, rgb: np.ndarray, start: int = 0) -> np.ndarray:
     yuv = rgb_to_yuv(rgb)
-    yuv = subsample(yuv) 
-    encoded = self._encode_yuv(yuv)
-    return yuv_to_rgb(encoded)
+    subsample(yuv, u=1 in self._channels, v=2 in self._channels, copy=False)
+    encoded = self._encode_yuv(yuv, start)
+    return yuv_to_rgb(encoded, out=encoded)
 
-  def _encode_yuv(self, yuv: np.ndarray) -> np.ndarray:
+  def _encode_yuv(self, yuv: np.ndarray, start: int = 0) -> np.ndarray:
     rows, columns, _ = yuv.shape
 
-    for channel in range(2):
-      if self._scales[channel] <= 0:
-        continue
-
+    for channel in self._channels:
       last_processed_row = rows // self._block * self._block
       last_processed_col = columns // self._block * self._block
 
+      # the transform runs in float64 and is truncated back to whole values
       ca1, (h1, v1, d1) = pywt.dwt2(
-          yuv[:last_processed_row, :last_processed_col, channel], 'haar')
+          yuv[:last_processed_row, :last_processed_col, channel].astype(np.float64), 'haar')
 
-      self.encode_frame(ca1, scale=self._scales[channel])
+      self.encode_frame(ca1, scale=self._scales[channel], start=start)
 
-      yuv[:last_processed_row, :last_processed_col, channel, ] = pywt.idwt2(
-          (ca1, (v1, h1, d1)), 'haar')
+      yuv[:last_processed_row, :last_processed_col, channel, ] = np.trunc(pywt.idwt2(
+          (ca1, (v1, h1, d1)), 'haar'))
 
     return yuv
 
-  def encode_frame(self, frame, scale):
+  def encode_frame(self, frame, scale, start=0):
     '''
     frame is a matrix (M, N)
 
     we get K (watermark bits size) blocks (self._block x self._block)
 
-    For i-th block, we encode watermark[i] bit into it
-    '''
-    (row, col) = frame.shape
-    num = 0
+    For i-th block, we encode watermark[i] bit into it, counting blocks
+    from start when frame is a strip of a larger image
 
-    for i in range(row // self._block):
-      for j in range(col // self._block):
-        block = frame[i * self._block: i * self._block + self._block,
-                      j * self._block: j * self._block + self._block]
-        wmBit = self._watermarks[(num % self._wmLen)]
-
-        diffusedBlock = self.diffuse_dct_matrix(block, wmBit, scale)
-
-        frame[i * self._block: i * self._block + self._block,
-              j * self._block: j * self._block + self._block] = diffusedBlock
+    All blocks are processed at once, producing the same result as calling
+    diffuse_dct_matrix on every block in turn
+    '''
+    rows, cols = _max_dct_coefficients(frame, self._block)
+    num = start + np.arange(rows.size).reshape(rows.shape)
+    bits = np.array(self._watermarks)[num % self._wmLen]
 
-        num = num + 1
+    val = frame[rows, cols]
+    diffused = (abs(val) // scale + 0.25 + (0.5 * bits)) * scale
+    frame[rows, cols] = np.where(val >= 0.0, diffused, -1.0 * diffused)
 
   def diffuse_dct_matrix(self, block, wmBit, scale):
     """
@@ -171,50 +273,53 @@ class EmbedMaxDct(object):
 
 
 class DecodeMaxDct(object):
-  def __init__(self, wm_length, scales=[0, 36, 36], block=4):
+  def __init__(self, wm_length, scales=[0, 36, 36], block=4, channels=[0, 1]):
     self._wmLen = wm_length
     self._scales = scales
     self._block = block
+    self._channels = [channel for channel in channels if scales[channel] > 0]
 
-  def decode_rgb(self, rgb: np.ndarray) -> np.ndarray:
+  def decode_rgb(self, rgb: np.ndarray, strip_rows: int = None) -> np.ndarray:
     rows, columns, __name__ = rgb.shape
 
-    yuv = rgb_to_yuv(rgb)
-
-    scores = [[] for i in range(self._wmLen)]
-    for channel in range(2):
-      if self._scales[channel] <= 0:
-        continue
+    scores = np.zeros(self._wmLen)
+    counts = np.zeros(self._wmLen)
+    for top, bottom, start in _strips(rows, columns, self._block, strip_rows):
+      yuv = rgb_to_yuv(rgb[top:bottom], channels=self._channels)
 
-      last_processed_row = rows // self._block * self._block
-      last_processed_col = columns // self._block * self._block
+      for i, channel in enumerate(self._channels):
+        last_processed_row = (bottom - top) // self._block * self._block
+        last_processed_col = columns // self._block * self._block
 
-      ca1, (_, _, _) = pywt.dwt2(
-          yuv[:last_processed_row, :last_processed_col, channel], 'haar')
+        ca1, (_, _, _) = pywt.dwt2(
+            yuv[:last_processed_row, :last_processed_col, i].astype(np.float64), 'haar')
 
-      scores = self.decode_frame(ca1, self._scales[channel], scores)
+        frame_scores, frame_counts = self.decode_frame(ca1, self._scales[channel], start)
+        scores += frame_scores
+        counts += frame_counts
 
-    avgScores = list(map(lambda l: np.array(l).mean(), scores))
+    avgScores = scores / np.maximum(counts, 1)
 
     bits = (np.array(avgScores) * 255 > 127)
     return bits
 
-  def decode_frame(self, frame, scale, scores):
-    (row, col) = frame.shape
-    num = 0
-
-    for i in range(row // self._block):
-      for j in range(col // self._block):
-        block = frame[i * self._block: i * self._block + self._block,
-                      j * self._block: j * self._block + self._block]
+  def decode_frame(self, frame, scale, start=0):
+    '''
+    Score every block of frame at once with the same rule as
+    infer_dct_matrix, then sum the scores per watermark bit, counting blocks
+    from start when frame is a strip of a larger image
 
-        wmBit = num % self._wmLen
-        score = self.infer_dct_matrix(block, scale)
+    Returns the per-bit score sums and the number of blocks behind each sum
+    '''
+    rows, cols = _max_dct_coefficients(frame, self._block)
+    wmBits = (start + np.arange(rows.size)) % self._wmLen
 
-        scores[wmBit].append(score)
-        num = num + 1
+    val = abs(frame[rows, cols]).ravel()
+    score = (val % scale) > 0.5 * scale
 
-    return scores
+    scores = np.bincount(wmBits, weights=score, minlength=self._wmLen)
+    counts = np.bincount(wmBits, minlength=self._wmLen)
+    return scores, counts
 
   def infer_dct_matrix(self, block, scale):
     pos = np.argmax(abs(block.flatten()[1:])) + 1
@@ -231,28 +336,39 @@ class DecodeMaxDct(object):
 
 
 class WatermarkEncoder(object):
-  def __init__(self, content=b''):
+  def __init__(self, content=b'', channels=[0, 1], scales=[0, 36, 36], block=4):
     seq = np.array([n for n in content], dtype=np.uint8)
     self._watermarks = list(np.unpackbits(seq))
     self._wmLen = len(self._watermarks)
+    self._channels = channels
+    self._scales = scales
+    self._block = block
 
   def get_length(self):
     return self._wmLen
 
-  def max_dwt_encode(self, rgb: np.ndarray) -> np.ndarray:
+  def max_dwt_encode(self, rgb: np.ndarray, strip_rows: int = None) -> np.ndarray:
     rows, columns, _ = rgb.shape
 
     if rows * columns < 256 * 256:
       raise RuntimeError(
           'image too small, should be larger than 256x256')
 
-    embed = EmbedMaxDct(self._watermarks)
-    return embed.encode_rgb(rgb)
+    if strip_rows is None and rows * columns > MAX_FRAME_PIXELS:
+      strip_rows = STRIP_ROWS
+    if strip_rows is not None and not rgb.flags.writeable:
+      rgb = rgb.copy()
+
+    embed = EmbedMaxDct(self._watermarks, scales=self._scales, block=self._block, channels=self._channels)
+    return embed.encode_rgb(rgb, strip_rows)
 
 
 class WatermarkDecoder(object):
-  def __init__(self, wm_length=0):
+  def __init__(self, wm_length=0, channels=[0, 1], scales=[0, 36, 36], block=4):
     self._wmLen = wm_length
+    self._channels = channels
+    self._scales = scales
+    self._block = block
 
   def _reconstruct_bytes(self, bits):
     nums = np.packbits(bits)
@@ -261,54 +377,82 @@ class WatermarkDecoder(object):
       bstr += struct.pack('>B', nums[i])
     return bstr
 
-  def decode(self, rgb) -> bytes:
+  def decode(self, rgb, strip_rows: int = None) -> bytes:
     rows, columns, _ = rgb.shape
     if rows * columns < 256 * 256:
       raise RuntimeError(
           'image too small, should be larger than 256x256')
 
+    if strip_rows is None and rows * columns > MAX_FRAME_PIXELS:
+      strip_rows = STRIP_ROWS
+
     bits = []
-    embed = DecodeMaxDct(wm_length=self._wmLen)
-    bits = embed.decode_rgb(rgb)
+    embed = DecodeMaxDct(wm_length=self._wmLen, scales=self._scales, block=self._block,
+                         channels=self._channels)
+    bits = embed.decode_rgb(rgb, strip_rows)
     return self._reconstruct_bytes(bits)
 
-def apply_watermark(img_buffer: bytes, jpeg_quality: int = 75,watermark: str = "SDV2"):
+def apply_watermark(img_buffer: bytes, jpeg_quality: int = 75,watermark: str = "SDV2",
+                    wm_encoder: WatermarkEncoder = None, format: str = "png", output=None,
+                    png_compress_level: int = 6, jpeg_subsampling: int = 0, strip_rows: int = None):
+  '''
+  Watermarks the image and encodes it as format ("jpeg" or "png").
+
+  If output (a path or file object) is given the encoded image is written straight
+  to it, otherwise it is returned in a BytesIO. Images above MAX_FRAME_PIXELS, or any
+  image when strip_rows is given, are watermarked in strips of strip_rows rows
+  '''
   if jpeg_quality < 0 or jpeg_quality > 100:
     raise ValueError("jpeg_quality must be between 0 and 100")
+  if format not in ("jpeg", "png"):
+    raise ValueError("format must be jpeg or png")
 
-  # Convert image bytes to numpy array
-  img = _bytes_to_nparray(img_buffer)
+  # Convert image bytes to numpy array, writable so strips can be encoded in place
+  img = _bytes_to_nparray(img_buffer, writeable=True)
 
   # Encode watermark into image
-  wm_encoder = WatermarkEncoder(watermark.encode('utf-8', 'replace'))
+  if wm_encoder is None:
+    wm_encoder = WatermarkEncoder(watermark.encode('utf-8', 'replace'))
 
-  encoded_img = wm_encoder.max_dwt_encode(img)
+  encoded_img = wm_encoder.max_dwt_encode(img, strip_rows)
   # Convert numpy array to image bytes
-  encoded_img = Image.fromarray(encoded_img.astype(np.uint8), 'RGB')
+  encoded_img = Image.fromarray(encoded_img.astype(np.uint8, copy=False), 'RGB')
 
-  encoded_img_bytes_png = io.BytesIO()
-  encoded_img_bytes_jpg = io.BytesIO()
+  encoded_img_bytes = output if output is not None else io.BytesIO()
 
-  encoded_img.save(encoded_img_bytes_jpg, format="jpeg",
-                   quality=jpeg_quality, subsampling=0)
-  encoded_img.save(encoded_img_bytes_png, format="png")
+  if format == "jpeg":
+    encoded_img.save(encoded_img_bytes, format="jpeg",
+                     quality=jpeg_quality, subsampling=jpeg_subsampling)
+  else:
+    encoded_img.save(encoded_img_bytes, format="png",
+                     compress_level=png_compress_level)
 
-  return encoded_img_bytes_jpg, encoded_img_bytes_png
+  return encoded_img_bytes
 
 
-def decode_watermark(encoded_img_buffer: io.BytesIO, wm_length=32) -> str:
+def decode_watermark(encoded_img_buffer: io.BytesIO, wm_length=32,
+                     wm_decoder: WatermarkDecoder = None, strip_rows: int = None) -> str:
   encoded_img_bytes = encoded_img_buffer.getvalue()
 
   # Convert image bytes to numpy array
   encoded_img = _bytes_to_nparray(encoded_img_bytes)
 
   # Decode watermark from image
-  wm_decoder = WatermarkDecoder(wm_length=wm_length)
-  watermark = wm_decoder.decode(encoded_img)
+  if wm_decoder is None:
+    wm_decoder = WatermarkDecoder(wm_length=wm_length)
+  watermark = wm_decoder.decode(encoded_img, strip_rows)
   decoded = watermark.decode('utf-8', 'replace')
   return decoded
 
-def _bytes_to_nparray(bytes: bytes) -> np.array:
+def _bytes_to_nparray(bytes: bytes, writeable: bool = False) -> np.array:
+  '''
+  Decodes the whole image into one uint8 RGB array
+
+  PIL can't decode PNG or JPEG a strip at a time, so memory always grows with
+  the image: 3 bytes per pixel here, plus one float strip while it is
+  watermarked and the compressed output. Images up to MAX_IMAGE_PIXELS are
+  accepted
+  '''
   start_time = time.time()
   # Convert image bytes to PIL image object
   img = Image.open(io.BytesIO(bytes))
@@ -318,8 +462,6 @@ def _bytes_to_nparray(bytes: bytes) -> np.array:
   #   f"image size: {width} x {height} = {(width * height):,} pixels")
   pixels = width * height
 
-  if pixels > 4096 * 4096:
-    raise ValueError("Image is too large. Max size is 4096 x 4096 pixels.")
   if pixels < 256 * 256:
     raise ValueError("Image is too small. Should be larger than 256x256 ")
 
@@ -335,31 +477,169 @@ def _bytes_to_nparray(bytes: bytes) -> np.array:
   # logging.info(f"time to convert to RGB:  {convert_time - preprocess_time}")
 
   # Convert PIL image object to numpy array
+  if writeable:
+    return np.array(img)
   return np.asarray(img)
 
-def encode(input, output, watermark, quality):
+def _output_format(output):
+    ext = pathlib.Path(output).suffix.lower()
+    if ext == ".jpg" or ext == ".jpeg":
+        return "jpeg"
+    elif ext == ".png":
+        return "png"
+    raise ValueError(f"Unsupported output format: {ext}")
+
+def _parse_channels(channels):
+    if not channels:
+        return [0, 1]
+    if isinstance(channels, str):
+        return [int(channel) for channel in channels.split(",")]
+    return [int(channel) for channel in channels]
+
+def encode(input, output, watermark, quality, wm_encoder=None, compress_level=None, channels=None,
+           strip_rows=None):
     watermark = watermark if watermark else "SDV2"
     quality = int(quality) if quality else 100
-    ext = pathlib.Path(output).suffix
+    compress_level = int(compress_level) if compress_level is not None else 6
+    strip_rows = int(strip_rows) if strip_rows else None
+    format = _output_format(output)
+    if wm_encoder is None:
+        wm_encoder = WatermarkEncoder(watermark.encode('utf-8', 'replace'), channels=_parse_channels(channels))
+    img = open(input, "rb").read()
+    apply_watermark(img, quality, watermark, wm_encoder, format=format, output=output,
+                    png_compress_level=compress_level, strip_rows=strip_rows)
+
+def decode(input, output, length, wm_decoder=None, channels=None, strip_rows=None):
+    length = int(length) if length else 4
+    strip_rows = int(strip_rows) if strip_rows else None
+    if wm_decoder is None:
+        wm_decoder = WatermarkDecoder(wm_length=length * 8, channels=_parse_channels(channels))
     img = io.BytesIO(open(input, "rb").read())
-    watermark_bytes = apply_watermark(img.read(), quality, watermark)
-    if ext == ".jpg" or ext == ".jpeg":
-        file = open(output, "wb")
-        file.write(watermark_bytes[0].getbuffer())
-        file.close()
-    elif ext == ".png":
-        file = open(output, "wb")
-        file.write(watermark_bytes[1].getbuffer())
+    decoded = decode_watermark(img, wm_length=length * 8, wm_decoder=wm_decoder, strip_rows=strip_rows)
+    if output:
+        file = open(output, "w")
+        file.write(decoded)
         file.close()
+    return decoded
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+
+# Per-process state for batch workers, built once by _init_batch_worker
+_batch_encoder = None
+_batch_decoder = None
+
+def _init_batch_worker(watermark, length, channels):
+    global _batch_encoder
+    global _batch_decoder
+    channels = _parse_channels(channels)
+    _batch_encoder = WatermarkEncoder(watermark.encode('utf-8', 'replace'), channels=channels)
+    _batch_decoder = WatermarkDecoder(wm_length=length * 8, channels=channels)
+
+def _encode_batch_file(input, output, watermark, quality, compress_level):
+    start_time = time.time()
+    try:
+        encode(input, output, watermark, quality, wm_encoder=_batch_encoder, compress_level=compress_level)
+        return {"file": input, "output": output, "watermark": watermark, "time": time.time() - start_time}
+    except Exception as e:
+        return {"file": input, "error": str(e), "time": time.time() - start_time}
+
+def _decode_batch_file(input, length):
+    start_time = time.time()
+    try:
+        decoded = decode(input, None, length, wm_decoder=_batch_decoder)
+        return {"file": input, "decoded": decoded, "time": time.time() - start_time}
+    except Exception as e:
+        return {"file": input, "error": str(e), "time": time.time() - start_time}
+
+def _batch_inputs(input):
+    if os.path.isdir(input):
+        files = [os.path.join(input, f) for f in os.listdir(input)]
+    else:
+        files = glob.glob(input)
+    return sorted(f for f in files if pathlib.Path(f).suffix.lower() in IMAGE_EXTENSIONS)
 
-def decode(input, output, length):
-    length = int(length) if length else 4
-    img = io.BytesIO(open(input, "rb").read())
-    decoded = decode_watermark(img, wm_length=length * 8)
-    file = open(output, "w")
-    file.write(decoded)
+def _write_manifest(manifest, results, start_time):
+    file = open(manifest, "w")
+    json.dump({"files": results, "time": time.time() - start_time}, file, indent=4)
     file.close()
 
+def encode_batch(input, output, watermark, quality, jobs=None, manifest=None, compress_level=None,
+                 channels=None):
+    """
+    Watermarks every image in a directory (or matching a glob) into the output directory,
+    spreading the files over a process pool, and writes a JSON manifest of the results.
+    """
+    start_time = time.time()
+    watermark = watermark if watermark else "SDV2"
+    files = _batch_inputs(input)
+    os.makedirs(output, exist_ok=True)
+    outputs = [os.path.join(output, os.path.basename(f)) for f in files]
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count(), initializer=_init_batch_worker,
+                             initargs=(watermark, 4, channels)) as executor:
+        results = list(executor.map(_encode_batch_file, files, outputs, [watermark] * len(files),
+                                    [quality] * len(files), [compress_level] * len(files)))
+    _write_manifest(manifest or os.path.join(output, "manifest.json"), results, start_time)
+    return results
+
+def decode_batch(input, output, length, jobs=None, channels=None):
+    """
+    Decodes every image in a directory (or matching a glob) over a process pool
+    and writes the decoded watermarks to a JSON manifest at output, which defaults
+    to decoded.json in the input directory (manifest.json there is encode-batch's).
+    """
+    start_time = time.time()
+    if not output:
+        if not os.path.isdir(input):
+            raise ValueError("decode-batch needs -o or --manifest when the input is a glob")
+        output = os.path.join(input, "decoded.json")
+    length = int(length) if length else 4
+    files = _batch_inputs(input)
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count(), initializer=_init_batch_worker,
+                             initargs=("", length, channels)) as executor:
+        results = list(executor.map(_decode_batch_file, files, [length] * len(files)))
+    _write_manifest(output, results, start_time)
+    return results
+
+def serve():
+    """
+    Process jobs from stdin, one JSON object per line, until EOF.
+
+    {"id": 1, "action": "encode", "input": "in.png", "output": "out.png", "watermark": "SDV2", "quality": 90}
+    {"id": 2, "action": "decode", "input": "out.png", "length": 4}
+
+    Each job gets one JSON line back on stdout with its id, a status of "ok" or "error"
+    and the time it took. Decode jobs also return the decoded text.
+    """
+    out = sys.stdout
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        start_time = time.time()
+        job = {}
+        try:
+            job = json.loads(line)
+            action = job.get("action")
+            # keep stray prints off the protocol stream
+            with contextlib.redirect_stdout(sys.stderr):
+                if action == "encode":
+                    encode(job.get("input"), job.get("output"), job.get("watermark"), job.get("quality"),
+                           compress_level=job.get("compress_level"), channels=job.get("channels"),
+                           strip_rows=job.get("strip_rows"))
+                    response = {"status": "ok"}
+                elif action == "decode":
+                    decoded = decode(job.get("input"), job.get("output"), job.get("length"),
+                                     channels=job.get("channels"), strip_rows=job.get("strip_rows"))
+                    response = {"status": "ok", "watermark": decoded}
+                else:
+                    raise ValueError(f"Unknown action: {action}")
+        except Exception as e:
+            response = {"status": "error", "error": str(e)}
+        response["id"] = job.get("id") if isinstance(job, dict) else None
+        response["time"] = time.time() - start_time
+        out.write(json.dumps(response) + "\n")
+        out.flush()
+
 def main():
     parser = argparse.ArgumentParser(prog="Invisible Watermark")
     parser.add_argument("-a", "--action")
@@ -368,13 +648,30 @@ def main():
     parser.add_argument("-w", "--watermark")
     parser.add_argument("-l", "--length")
     parser.add_argument("-q", "--quality")
+    parser.add_argument("-c", "--compress-level")
+    parser.add_argument("-j", "--jobs")
+    parser.add_argument("-m", "--manifest")
+    parser.add_argument("--channels")
+    parser.add_argument("--strip-rows")
+    parser.add_argument("--serve", action="store_true")
+    parser.add_argument("--no-install", action="store_true")
     args = parser.parse_args()
     action = args.action
 
-    if action == "encode":
-        encode(args.input, args.output, args.watermark, args.quality)
+    if args.serve:
+        serve()
+    elif action == "encode":
+        encode(args.input, args.output, args.watermark, args.quality, compress_level=args.compress_level,
+               channels=args.channels, strip_rows=args.strip_rows)
     elif action == "decode":
-        decode(args.input, args.output, args.length)
+        decode(args.input, args.output, args.length, channels=args.channels, strip_rows=args.strip_rows)
+    elif action == "encode-batch":
+        jobs = int(args.jobs) if args.jobs else None
+        encode_batch(args.input, args.output, args.watermark, args.quality, jobs, args.manifest,
+                     args.compress_level, args.channels)
+    elif action == "decode-batch":
+        jobs = int(args.jobs) if args.jobs else None
+        decode_batch(args.input, args.manifest or args.output, args.length, jobs, args.channels)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
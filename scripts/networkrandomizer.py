@@ -1,14 +1,6 @@
-import sys
-import subprocess
-import pkg_resources
+import bootstrap
 
-required = {"torch", "pytorch_lightning", "safetensors", "onnx"}
-installed = {pkg.key for pkg in pkg_resources.working_set}
-missing = required - installed
-
-if missing:
-    python = sys.executable
-    subprocess.check_call([python, "-m", "pip", "install", *missing], stdout=subprocess.DEVNULL)
+bootstrap.ensure_requirements({"torch", "pytorch_lightning", "safetensors", "onnx"})
 
 import os
 import torch 
@@ -156,6 +148,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="Network Randomizer")
     parser.add_argument("-i", "--input")
     parser.add_argument("-o", "--output")
+    parser.add_argument("--no-install", action="store_true")
     args = parser.parse_args()
 
     ext = pathlib.Path(args.input).suffix
@@ -0,0 +1,143 @@
+import argparse
+import io
+import json
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pywt
+from PIL import Image
+import invisiblewatermark as wm
+
+def synthetic_image(size, seed=0):
+    """
+    A deterministic size x size RGB image: smooth gradients with a little noise,
+    so the watermark decodes the same way it would on a real picture.
+    """
+    y, x = np.mgrid[0:size, 0:size] / size
+    rgb = np.stack([x * 255, y * 255, (x + y) * 127.5], axis=-1)
+    rgb += np.random.default_rng(seed).normal(0, 4, rgb.shape)
+    return np.clip(rgb, 0, 255).astype(np.uint8)
+
+def measure(func, repeat):
+    """
+    Runs func repeat times and returns (best time in seconds, peak bytes allocated by one run).
+    Memory is what tracemalloc sees, which covers NumPy buffers but not PIL's internal ones.
+    """
+    times = []
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return min(times), peak
+
+def _float64_conversion(values, m, before, after):
+    # the conversion as the float64 path computes it
+    converted = np.dot(values.astype(np.float64) + before, m) + after
+    return np.round(np.clip(converted, 0, 255))
+
+def check_conversions(chunk=1 << 20):
+    """
+    Converts every 24-bit value both ways and counts the elements where rgb_to_yuv and
+    yuv_to_rgb differ from the float64 path. Both counts should be 0.
+    """
+    to_yuv = np.array([[0.29900, -0.14713, 0.615], [0.58700, -0.28886, -0.51499], [0.11400, 0.436, -0.10001]])
+    to_rgb = np.array([[1.000, 1.000, 1.000], [0.000, -0.39465, 2.03211], [1.13983, -0.58060, 0.000]])
+    chroma = np.array([0, 127.5, 127.5])
+    mismatches = {"rgb_to_yuv": 0, "yuv_to_rgb": 0}
+    for start in range(0, 1 << 24, chunk):
+        values = np.arange(start, start + chunk, dtype=np.uint32)
+        pixels = np.stack([values >> 16, (values >> 8) & 255, values & 255], axis=-1).astype(np.uint8)[None]
+        expected = _float64_conversion(pixels, to_yuv, 0, chroma)
+        mismatches["rgb_to_yuv"] += int(np.sum(wm.rgb_to_yuv(pixels) != expected))
+        expected = _float64_conversion(pixels, to_rgb, -chroma, 0)
+        mismatches["yuv_to_rgb"] += int(np.sum(wm.yuv_to_rgb(pixels.astype(np.float32)) != expected))
+    return mismatches
+
+def benchmark_size(size, repeat, watermark="SDV2", quality=90):
+    rgb = synthetic_image(size)
+    png = io.BytesIO()
+    Image.fromarray(rgb).save(png, format="png")
+    png_bytes = png.getvalue()
+
+    encoder = wm.WatermarkEncoder(watermark.encode("utf-8"))
+    bits = encoder._watermarks
+    block = 4
+    scale = 36
+
+    # inputs for each stage, prepared outside the timed region
+    yuv = wm.rgb_to_yuv(rgb)
+    subsampled = wm.subsample(yuv)
+    edge = size // block * block
+    plane = subsampled[:edge, :edge, 1].astype(np.float64)
+    ca1, (h1, v1, d1) = pywt.dwt2(plane, "haar")
+    encoded = wm.EmbedMaxDct(bits).encode_rgb(rgb)
+    encoded_img = Image.fromarray(encoded.astype(np.uint8), "RGB")
+    encoded_png = io.BytesIO()
+    encoded_img.save(encoded_png, format="png")
+
+    stages = {
+        "rgb_to_yuv": lambda: wm.rgb_to_yuv(rgb),
+        "subsample": lambda: wm.subsample(yuv),
+        "dwt2": lambda: pywt.dwt2(plane, "haar"),
+        "encode_frame": lambda: wm.EmbedMaxDct(bits).encode_frame(ca1.copy(), scale),
+        "idwt2": lambda: pywt.idwt2((ca1, (v1, h1, d1)), "haar"),
+        "yuv_to_rgb": lambda: wm.yuv_to_rgb(subsampled),
+        "decode_frame": lambda: wm.DecodeMaxDct(len(bits)).decode_frame(ca1, scale),
+        "save_jpeg": lambda: encoded_img.save(io.BytesIO(), format="jpeg", quality=quality, subsampling=0),
+        "save_png": lambda: encoded_img.save(io.BytesIO(), format="png"),
+        "encode": lambda: wm.apply_watermark(png_bytes, quality, watermark, format="png"),
+        "decode": lambda: wm.decode_watermark(encoded_png, wm_length=len(bits)),
+    }
+
+    results = {}
+    for name, func in stages.items():
+        seconds, peak = measure(func, repeat)
+        results[name] = {"seconds": seconds, "peak_mb": peak / (1024 * 1024)}
+    for name in ("encode", "decode"):
+        results[name]["images_per_second"] = 1 / results[name]["seconds"]
+    return results
+
+def print_results(size, results):
+    print(f"{size}x{size}")
+    for name, result in results.items():
+        line = f"  {name:<14}{result['seconds'] * 1000:>10.2f} ms{result['peak_mb']:>10.1f} MB"
+        if "images_per_second" in result:
+            line += f"{result['images_per_second']:>10.2f} img/s"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(prog="Watermark Benchmark")
+    parser.add_argument("-s", "--sizes")
+    parser.add_argument("-r", "--repeat")
+    parser.add_argument("-o", "--output")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--no-install", action="store_true")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")] if args.sizes else [256, 1024, 4096]
+    repeat = int(args.repeat) if args.repeat else 3
+
+    if args.check:
+        mismatches = check_conversions()
+        print(f"conversion mismatches against float64: {mismatches}")
+        if any(mismatches.values()):
+            sys.exit(1)
+
+    report = {}
+    for size in sizes:
+        results = benchmark_size(size, repeat)
+        print_results(size, results)
+        report[size] = results
+
+    if args.output:
+        file = open(args.output, "w")
+        json.dump(report, file, indent=4)
+        file.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+import invisiblewatermark as wm
+
+def _parse_list(value, default, type=int):
+    return [type(item) for item in value.split(",")] if value else default
+
+def _psnr(original, encoded):
+    mse = np.mean((original.astype(np.float64) - encoded.astype(np.float64)) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+def sweep_image(input, scale, block, qualities, watermark, subsampling=0):
+    """
+    Encodes one image with one scale/block setting, passes the result through JPEG at
+    each quality (with PIL's subsampling option, 0 for 4:4:4 as apply_watermark saves, 2 for
+    the 4:2:0 most re-encoders use) and decodes it again. Returns one result per quality.
+    """
+    rgb = np.asarray(Image.open(input).convert("RGB"))
+    content = watermark.encode("utf-8", "replace")
+    bits = np.unpackbits(np.frombuffer(content, dtype=np.uint8))
+    scales = [0, scale, scale]
+
+    start_time = time.perf_counter()
+    encoder = wm.WatermarkEncoder(content, scales=scales, block=block)
+    encoded = encoder.max_dwt_encode(rgb).astype(np.uint8)
+    encode_time = time.perf_counter() - start_time
+    psnr = _psnr(rgb, encoded)
+
+    results = []
+    decoder = wm.WatermarkDecoder(len(bits), scales=scales, block=block)
+    for quality in qualities:
+        jpeg = io.BytesIO()
+        Image.fromarray(encoded).save(jpeg, format="jpeg", quality=quality, subsampling=subsampling)
+        jpeg_rgb = np.asarray(Image.open(jpeg).convert("RGB"))
+
+        start_time = time.perf_counter()
+        decoded = decoder.decode(jpeg_rgb)
+        decode_time = time.perf_counter() - start_time
+
+        decoded_bits = np.unpackbits(np.frombuffer(decoded, dtype=np.uint8))
+        results.append({"file": input, "scale": scale, "block": block, "quality": quality,
+                        "bit_error_rate": float(np.mean(decoded_bits != bits)), "psnr": psnr,
+                        "pixels": rgb.shape[0] * rgb.shape[1],
+                        "encode_time": encode_time, "decode_time": decode_time})
+    return results
+
+def summarize(results):
+    """
+    Averages the per-image results for every scale/block/quality setting.
+    """
+    groups = {}
+    for result in results:
+        groups.setdefault((result["scale"], result["block"], result["quality"]), []).append(result)
+
+    summary = []
+    for (scale, block, quality), group in sorted(groups.items()):
+        pixels = sum(result["pixels"] for result in group)
+        summary.append({
+            "scale": scale, "block": block, "quality": quality, "images": len(group),
+            "bit_error_rate": float(np.mean([result["bit_error_rate"] for result in group])),
+            "failed": sum(result["bit_error_rate"] > 0 for result in group),
+            "psnr": float(np.mean([result["psnr"] for result in group])),
+            "encode_mpx_per_second": pixels / 1e6 / sum(result["encode_time"] for result in group),
+            "decode_mpx_per_second": pixels / 1e6 / sum(result["decode_time"] for result in group),
+        })
+    return summary
+
+def sweep(inputs, scales, blocks, qualities, watermark, subsampling=0, jobs=None):
+    tasks = [(input, scale, block) for input in inputs for scale in scales for block in blocks]
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        futures = [executor.submit(sweep_image, input, scale, block, qualities, watermark, subsampling)
+                   for input, scale, block in tasks]
+        results = [result for future in futures for result in future.result()]
+    return results, summarize(results)
+
+def print_summary(summary):
+    print(f"{'scale':>6}{'block':>6}{'quality':>8}{'BER':>8}{'failed':>8}{'PSNR':>8}{'enc MP/s':>10}{'dec MP/s':>10}")
+    for row in summary:
+        print(f"{row['scale']:>6}{row['block']:>6}{row['quality']:>8}{row['bit_error_rate']:>8.3f}"
+              f"{row['failed']:>8}{row['psnr']:>8.2f}{row['encode_mpx_per_second']:>10.2f}"
+              f"{row['decode_mpx_per_second']:>10.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(prog="Watermark Sweep")
+    parser.add_argument("-i", "--input")
+    parser.add_argument("-o", "--output")
+    parser.add_argument("-w", "--watermark")
+    parser.add_argument("-s", "--scales")
+    parser.add_argument("-b", "--blocks")
+    parser.add_argument("-q", "--qualities")
+    parser.add_argument("-x", "--subsampling")
+    parser.add_argument("-j", "--jobs")
+    parser.add_argument("--no-install", action="store_true")
+    args = parser.parse_args()
+
+    inputs = wm._batch_inputs(args.input)
+    scales = _parse_list(args.scales, [12, 24, 36, 48])
+    blocks = _parse_list(args.blocks, [4, 8])
+    qualities = _parse_list(args.qualities, [95, 90, 80, 70, 50])
+    watermark = args.watermark if args.watermark else "SDV2"
+    subsampling = int(args.subsampling) if args.subsampling else 0
+    jobs = int(args.jobs) if args.jobs else None
+
+    results, summary = sweep(inputs, scales, blocks, qualities, watermark, subsampling, jobs)
+    print_summary(summary)
+
+    if args.output:
+        file = open(args.output, "w")
+        json.dump({"summary": summary, "results": results}, file, indent=4)
+        file.close()
+
+if __name__ == "__main__":
+    main()